@@ -1,101 +1,149 @@
+import asyncio
 import datetime
 import logging.config
+import shelve
 from environs import Env
 from seller import download_stock
 
+import aiohttp
+import orjson
 import requests
 
-from seller import divide, price_conversion
+from seller import (
+    RateLimiter,
+    create_client_session,
+    create_session,
+    divide,
+    prices_conversion,
+    send_request,
+    stock_conversion,
+)
 
 logger = logging.getLogger(__file__)
 
+MARKET_BASE = "https://api.partner.market.yandex.ru/"
+ETAG_CACHE = "market_cache"
 
-def get_product_list(page, campaign_id, access_token):
-    """Функция получает список продуктов.
 
-    Данная функция делает запрос с целью получить список продуктов компании.
+def market_headers(access_token):
+    """Функция возвращает заголовки для запросов к Яндекс маркету.
 
     Args:
-        page (str): Номер страницы
-        campaign_id (str): Индивидуальный ID номер компании.
         access_token (str): Персональный токен для доступа к Яндекс
 
     Returns:
-        list: Возвращает список продуктов.
+        dict: Заголовки запроса.
 
     """
-    endpoint_url = "https://api.partner.market.yandex.ru/"
-    headers = {
+    return {
         "Content-Type": "application/json",
         "Authorization": f"Bearer {access_token}",
         "Accept": "application/json",
-        "Host": "api.partner.market.yandex.ru",
     }
+
+
+def market_session(access_token):
+    """Функция создает сессию для работы с Яндекс маркетом.
+
+    Args:
+        access_token (str): Персональный токен для доступа к Яндекс
+
+    Returns:
+        requests.Session: Сессия с заголовками авторизации.
+
+    """
+    session = create_session()
+    session.headers.update(market_headers(access_token))
+    return session
+
+
+def get_product_list(page, campaign_id, session, cache=None):
+    """Функция получает список продуктов.
+
+    Данная функция делает запрос с целью получить список продуктов компании.
+    Если передан кэш, запрос делается условным: при ответе 304 страница
+    берется из кэша.
+
+    Args:
+        page (str): Номер страницы
+        campaign_id (str): Индивидуальный ID номер компании.
+        session (requests.Session): Сессия из market_session
+        cache (shelve.Shelf): Кэш страниц с ETag и Last-Modified.
+
+    Returns:
+        list: Возвращает список продуктов.
+
+    """
     payload = {
         "page_token": page,
         "limit": 200,
     }
-    url = endpoint_url + f"campaigns/{campaign_id}/offer-mapping-entries"
-    response = requests.get(url, headers=headers, params=payload)
+    url = MARKET_BASE + f"campaigns/{campaign_id}/offer-mapping-entries"
+    cached = cache.get(page) if cache is not None else None
+    headers = {}
+    if cached:
+        if cached["etag"]:
+            headers["If-None-Match"] = cached["etag"]
+        if cached["last_modified"]:
+            headers["If-Modified-Since"] = cached["last_modified"]
+    response = session.get(url, params=payload, headers=headers)
+    if cached and response.status_code == 304:
+        return cached["result"]
     response.raise_for_status()
-    response_object = response.json()
+    response_object = orjson.loads(response.content)
+    etag = response.headers.get("ETag")
+    last_modified = response.headers.get("Last-Modified")
+    if cache is not None and (etag or last_modified):
+        cache[page] = {
+            "etag": etag,
+            "last_modified": last_modified,
+            "result": response_object.get("result"),
+        }
     return response_object.get("result")
 
 
-def update_stocks(stocks, campaign_id, access_token):
+async def update_stocks(stocks, campaign_id, session, limiter):
     """Функция обновляет остатки на складе.
 
     Args:
         stocks (list): Список, остатков для обновления
         campaign_id (str): Персональный id компании
-        access_token (str): токен для доступа к Яндекс маркету
+        session (aiohttp.ClientSession): Сессия с заголовками market_headers
+        limiter (RateLimiter): Ограничитель частоты запросов
 
     Returns:
         dict: Возвращает словарь с обновленными товарами.
 
     """
-    endpoint_url = "https://api.partner.market.yandex.ru/"
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {access_token}",
-        "Accept": "application/json",
-        "Host": "api.partner.market.yandex.ru",
-    }
     payload = {"skus": stocks}
-    url = endpoint_url + f"campaigns/{campaign_id}/offers/stocks"
-    response = requests.put(url, headers=headers, json=payload)
-    response.raise_for_status()
-    response_object = response.json()
+    url = MARKET_BASE + f"campaigns/{campaign_id}/offers/stocks"
+    response_object = await send_request(
+        session, limiter, "PUT", url, data=orjson.dumps(payload)
+    )
     return response_object
 
 
-def update_price(prices, campaign_id, access_token):
+async def update_price(prices, campaign_id, session, limiter):
     """Функция обновляет цены в Яндекс.Маркет
 
     Функция применяется для того, чтобы заменить цены используя персональный
-    id компании, и токен доступа.
+    id компании, и сессию с токеном доступа.
 
     Args:
         prices (list): Список цен, на которые будут менять.
         campaign_id (str): Персональный id компании.
-        access_token (str): Токен доступа.
+        session (aiohttp.ClientSession): Сессия с заголовками market_headers
+        limiter (RateLimiter): Ограничитель частоты запросов
 
     Returns:
         dict: Словарь с обновленной ценой.
 
     """
-    endpoint_url = "https://api.partner.market.yandex.ru/"
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {access_token}",
-        "Accept": "application/json",
-        "Host": "api.partner.market.yandex.ru",
-    }
     payload = {"offers": prices}
-    url = endpoint_url + f"campaigns/{campaign_id}/offer-prices/updates"
-    response = requests.post(url, headers=headers, json=payload)
-    response.raise_for_status()
-    response_object = response.json()
+    url = MARKET_BASE + f"campaigns/{campaign_id}/offer-prices/updates"
+    response_object = await send_request(
+        session, limiter, "POST", url, data=orjson.dumps(payload)
+    )
     return response_object
 
 
@@ -110,27 +158,41 @@ def get_offer_ids(campaign_id, market_token):
         list: Возвращает список артикул товара.
 
     """
+    # nextPageToken известен только из ответа, поэтому страницы идут по очереди
     page = ""
-    product_list = []
-    while True:
-        some_prod = get_product_list(page, campaign_id, market_token)
-        product_list.extend(some_prod.get("offerMappingEntries"))
-        page = some_prod.get("paging").get("nextPageToken")
-        if not page:
-            break
     offer_ids = []
-    for product in product_list:
-        offer_ids.append(product.get("offer").get("shopSku"))
+    # Отдельный файл кэша на компанию: FBS и DBS читаются одновременно
+    cache_file = f"{ETAG_CACHE}_{campaign_id}"
+    visited = set()
+    with market_session(market_token) as session, shelve.open(cache_file) as cache:
+        while True:
+            visited.add(page)
+            some_prod = get_product_list(page, campaign_id, session, cache)
+            offer_ids.extend(
+                product.get("offer").get("shopSku")
+                for product in some_prod.get("offerMappingEntries")
+            )
+            page = some_prod.get("paging").get("nextPageToken")
+            if not page:
+                break
+        # Страницы, до которых обход больше не доходит, удаляем из кэша
+        stale_pages = set(cache.keys()) - visited
+        for stale_page in stale_pages:
+            del cache[stale_page]
+        # gdbm освобождает место на диске только после reorganize
+        reorganize = getattr(cache.dict, "reorganize", None)
+        if stale_pages and reorganize is not None:
+            reorganize()
     return offer_ids
 
 
 def create_stocks(watch_remnants, offer_ids, warehouse_id):
     """Функция создает лоты.
 
-    Функция принимает словарь и выводит обновленный словарь.
+    Функция принимает таблицу остатков и выводит список лотов.
 
     Args:
-        watch_remnants (dict): Словарь в котором хранатяся часы.
+        watch_remnants (pd.DataFrame): Таблица в которой хранатяся часы.
         offer_ids (list): Список содержащий id.
         warehouse_id (str): Id Хранилища для товара.
 
@@ -139,33 +201,30 @@ def create_stocks(watch_remnants, offer_ids, warehouse_id):
 
     """
     # Уберем то, что не загружено в market
-    stocks = list()
+    offer_ids_set = set(offer_ids)
     date = str(datetime.datetime.utcnow().replace(microsecond=0).isoformat() + "Z")
-    for watch in watch_remnants:
-        if str(watch.get("Код")) in offer_ids:
-            count = str(watch.get("Количество"))
-            if count == ">10":
-                stock = 100
-            elif count == "1":
-                stock = 0
-            else:
-                stock = int(watch.get("Количество"))
-            stocks.append(
+    codes = watch_remnants["Код"].astype(str)
+    # Каждый товар берем один раз, по первой строке с его кодом
+    loaded = codes.isin(offer_ids_set) & ~codes.duplicated()
+    counts = stock_conversion(watch_remnants.loc[loaded, "Количество"])
+    stocks = [
+        {
+            "sku": code,
+            "warehouseId": warehouse_id,
+            "items": [
                 {
-                    "sku": str(watch.get("Код")),
-                    "warehouseId": warehouse_id,
-                    "items": [
-                        {
-                            "count": stock,
-                            "type": "FIT",
-                            "updatedAt": date,
-                        }
-                    ],
+                    "count": stock,
+                    "type": "FIT",
+                    "updatedAt": date,
                 }
-            )
-            offer_ids.remove(str(watch.get("Код")))
+            ],
+        }
+        for code, stock in zip(codes[loaded], counts.tolist())
+    ]
     # Добавим недостающее из загруженного:
-    for offer_id in offer_ids:
+    matched = set(codes[loaded])
+    missing = offer_ids_set - matched
+    for offer_id in missing:
         stocks.append(
             {
                 "sku": offer_id,
@@ -188,75 +247,137 @@ def create_prices(watch_remnants, offer_ids):
     Функция принимает в себя остатки, и артикулы товара.
 
     Args:
-        watch_remnants (dict): Словарь с остатками товара.
+        watch_remnants (pd.DataFrame): Таблица с остатками товара.
         offer_ids (list): Список содержащий артикулы.
 
     Returns:
         list: Возвращает список цен.
 
     """
-    prices = []
-    for watch in watch_remnants:
-        if str(watch.get("Код")) in offer_ids:
-            price = {
-                "id": str(watch.get("Код")),
-                "price": {
-                    "value": int(price_conversion(watch.get("Цена"))),
-                    "currencyId": "RUR",
-                },
-            }
-            prices.append(price)
-    return prices
-
-
-async def upload_prices(watch_remnants, campaign_id, market_token):
+    codes = watch_remnants["Код"].astype(str)
+    loaded = codes.isin(set(offer_ids))
+    values = prices_conversion(watch_remnants.loc[loaded, "Цена"]).astype(int)
+    return [
+        {
+            "id": code,
+            "price": {
+                "value": value,
+                "currencyId": "RUR",
+            },
+        }
+        for code, value in zip(codes[loaded], values.tolist())
+    ]
+
+
+async def upload_prices(
+    watch_remnants, campaign_id, market_token, offer_ids=None, limiter=None
+):
     """Функция возвращает цены.
 
     Асинхронная функция, которая обновляет, и загружает цены на Яндекс маркет.
 
     Args:
-        watch_remnants (dict): Словарь с остатками товара.
+        watch_remnants (pd.DataFrame): Таблица с остатками товара.
         campaign_id (str): Персональный ID компании.
         market_token (str): Токен для работы с Яндекс маркетом.
+        offer_ids (list): Артикулы товаров. Если не переданы, запрашиваются
+            у Яндекс маркета.
+        limiter (RateLimiter): Ограничитель частоты запросов. Общий для всех
+            загрузок с одними учетными данными, если не передан - создается
 
     Returns:
         list: Возвращает список цен обновленные на маркете.
 
     """
-    offer_ids = get_offer_ids(campaign_id, market_token)
+    if offer_ids is None:
+        offer_ids = await asyncio.to_thread(get_offer_ids, campaign_id, market_token)
     prices = create_prices(watch_remnants, offer_ids)
-    for some_prices in list(divide(prices, 500)):
-        update_price(some_prices, campaign_id, market_token)
+    if limiter is None:
+        limiter = RateLimiter()
+    async with create_client_session(market_headers(market_token)) as session:
+        tasks = [
+            update_price(some_prices, campaign_id, session, limiter)
+            for some_prices in divide(prices, 500)
+        ]
+        await asyncio.gather(*tasks)
     return prices
 
 
-async def upload_stocks(watch_remnants, campaign_id, market_token, warehouse_id):
+async def upload_stocks(
+    watch_remnants,
+    campaign_id,
+    market_token,
+    warehouse_id,
+    offer_ids=None,
+    limiter=None,
+):
     """Функция загружает остатки на Яндекс маркет.
 
     Асинхронная функция загружает те товары, что есть в наличии.
 
     Args:
-        watch_remnants (dict): Словарь содержащий остатки товара.
+        watch_remnants (pd.DataFrame): Таблица содержащая остатки товара.
         campaign_id (str): Идентификационный номер комании поставщика.
         market_token (str): Токен, для работы с Яндекс маркетом.
         warehouse_id (str): Идентификационный номер хранилища товара.
+        offer_ids (list): Артикулы товаров. Если не переданы, запрашиваются
+            у Яндекс маркета.
+        limiter (RateLimiter): Ограничитель частоты запросов. Общий для всех
+            загрузок с одними учетными данными, если не передан - создается
 
     Returns:
         list: not_empty - список для не пустых лотов.
         list: stocks - Список для хранилища.
 
     """
-    offer_ids = get_offer_ids(campaign_id, market_token)
+    if offer_ids is None:
+        offer_ids = await asyncio.to_thread(get_offer_ids, campaign_id, market_token)
     stocks = create_stocks(watch_remnants, offer_ids, warehouse_id)
-    for some_stock in list(divide(stocks, 2000)):
-        update_stocks(some_stock, campaign_id, market_token)
+    if limiter is None:
+        limiter = RateLimiter()
+    async with create_client_session(market_headers(market_token)) as session:
+        tasks = [
+            update_stocks(some_stock, campaign_id, session, limiter)
+            for some_stock in divide(stocks, 2000)
+        ]
+        await asyncio.gather(*tasks)
     not_empty = list(
         filter(lambda stock: (stock.get("items")[0].get("count") != 0), stocks)
     )
     return not_empty, stocks
 
 
-def main():
+async def process_campaign(
+    watch_remnants, campaign_id, market_token, warehouse_id, limiter=None
+):
+    """Функция одновременно обновляет остатки и цены компании.
+
+    Args:
+        watch_remnants (pd.DataFrame): Таблица содержащая остатки товара.
+        campaign_id (str): Идентификационный номер комании поставщика.
+        market_token (str): Токен, для работы с Яндекс маркетом.
+        warehouse_id (str): Идентификационный номер хранилища товара.
+        limiter (RateLimiter): Ограничитель частоты запросов для остатков и
+            цен компании. Если не передан, создается один на обе загрузки.
+
+    """
+    offer_ids = await asyncio.to_thread(get_offer_ids, campaign_id, market_token)
+    if limiter is None:
+        limiter = RateLimiter()
+    await asyncio.gather(
+        upload_stocks(
+            watch_remnants,
+            campaign_id,
+            market_token,
+            warehouse_id,
+            offer_ids,
+            limiter,
+        ),
+        upload_prices(watch_remnants, campaign_id, market_token, offer_ids, limiter),
+    )
+
+
+async def main():
     env = Env()
     market_token = env.str("MARKET_TOKEN")
     campaign_fbs_id = env.str("FBS_ID")
@@ -265,31 +386,36 @@ def main():
     warehouse_dbs_id = env.str("WAREHOUSE_DBS_ID")
 
     watch_remnants = download_stock()
+    # Обе компании работают с одним токеном, поэтому ограничитель общий
+    limiter = RateLimiter()
     try:
-        # FBS
-        offer_ids = get_offer_ids(campaign_fbs_id, market_token)
-        # Обновить остатки FBS
-        stocks = create_stocks(watch_remnants, offer_ids, warehouse_fbs_id)
-        for some_stock in list(divide(stocks, 2000)):
-            update_stocks(some_stock, campaign_fbs_id, market_token)
-        # Поменять цены FBS
-        upload_prices(watch_remnants, campaign_fbs_id, market_token)
-
-        # DBS
-        offer_ids = get_offer_ids(campaign_dbs_id, market_token)
-        # Обновить остатки DBS
-        stocks = create_stocks(watch_remnants, offer_ids, warehouse_dbs_id)
-        for some_stock in list(divide(stocks, 2000)):
-            update_stocks(some_stock, campaign_dbs_id, market_token)
-        # Поменять цены DBS
-        upload_prices(watch_remnants, campaign_dbs_id, market_token)
-    except requests.exceptions.ReadTimeout:
+        # Обновить остатки и поменять цены FBS и DBS
+        await asyncio.gather(
+            process_campaign(
+                watch_remnants,
+                campaign_fbs_id,
+                market_token,
+                warehouse_fbs_id,
+                limiter,
+            ),
+            process_campaign(
+                watch_remnants,
+                campaign_dbs_id,
+                market_token,
+                warehouse_dbs_id,
+                limiter,
+            ),
+        )
+    except (requests.exceptions.ReadTimeout, asyncio.TimeoutError):
         print("Превышено время ожидания...")
-    except requests.exceptions.ConnectionError as error:
+    except (
+        requests.exceptions.ConnectionError,
+        aiohttp.ClientConnectionError,
+    ) as error:
         print(error, "Ошибка соединения")
     except Exception as error:
         print(error, "ERROR_2")
 
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())
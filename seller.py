@@ -1,15 +1,197 @@
+import asyncio
 import io
 import logging.config
-import os
 import re
+import time
 import zipfile
+from collections.abc import Iterable
+from itertools import islice
 from environs import Env
 
+import aiohttp
+import orjson
 import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 logger = logging.getLogger(__file__)
 
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+MAX_RETRIES = 5
+BACKOFF_FACTOR = 0.5
+MAX_RETRY_DELAY = 60
+MAX_REQUESTS_PER_SECOND = 10
+MAX_CONCURRENT_REQUESTS = 20
+_PRICE_RE = re.compile(r"[^0-9]")
+
+
+def create_session():
+    """Создает сессию с пулом соединений и повтором запросов.
+
+    Сессия переиспользует TCP/TLS соединения между запросами и повторяет
+    запрос при ответах 429 и 5xx.
+
+    Returns:
+        requests.Session: Настроенная сессия.
+    """
+    retries = Retry(
+        total=MAX_RETRIES,
+        backoff_factor=BACKOFF_FACTOR,
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods=None,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=32, max_retries=retries)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    return session
+
+
+SESSION = create_session()
+
+
+def create_client_session(headers=None):
+    """Создает асинхронную сессию для параллельной загрузки данных.
+
+    Должна создаваться внутри запущенного цикла событий.
+
+    Args:
+        headers (dict): Заголовки, которые отправляются с каждым запросом.
+
+    Returns:
+        aiohttp.ClientSession: Сессия с пулом до 64 соединений на хост.
+    """
+    connector = aiohttp.TCPConnector(limit_per_host=64)
+    return aiohttp.ClientSession(connector=connector, headers=headers)
+
+
+class RateLimiter:
+    """Ограничивает частоту и число одновременных запросов к API.
+
+    Частота ограничивается алгоритмом token bucket, число одновременных
+    запросов - семафором. Используется как асинхронный контекстный менеджер.
+
+    Args:
+        rate (float): Допустимое число запросов в секунду.
+        max_at_once (int): Допустимое число одновременных запросов.
+    """
+
+    def __init__(
+        self, rate=MAX_REQUESTS_PER_SECOND, max_at_once=MAX_CONCURRENT_REQUESTS
+    ):
+        self.rate = rate
+        self.tokens = rate
+        self.updated_at = time.monotonic()
+        self.paused_until = 0
+        self.lock = asyncio.Lock()
+        self.semaphore = asyncio.Semaphore(max_at_once)
+
+    async def __aenter__(self):
+        await self.semaphore.acquire()
+        try:
+            await self.take_token()
+        except BaseException:
+            self.semaphore.release()
+            raise
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.semaphore.release()
+
+    async def take_token(self):
+        """Дождаться свободного токена и забрать его."""
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                elapsed = now - self.updated_at
+                self.tokens = min(self.rate, self.tokens + elapsed * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, delay):
+        """Не выдавать токены delay секунд, пока у API не обновится квота.
+
+        После паузы токены начинают копиться заново, с пустой корзины.
+        Пауза не длиннее MAX_RETRY_DELAY секунд.
+        """
+        delay = min(delay, MAX_RETRY_DELAY)
+        self.paused_until = max(self.paused_until, time.monotonic() + delay)
+        self.tokens = 0
+        self.updated_at = self.paused_until
+
+
+def retry_delay(headers, attempt):
+    """Вычисляет, сколько ждать перед следующим запросом.
+
+    Берется время из заголовка Retry-After, затем из X-RateLimit-Reset.
+    Если их нет, или значение больше MAX_RETRY_DELAY, задержка растет
+    экспоненциально с номером попытки.
+
+    Args:
+        headers (Mapping): Заголовки ответа
+        attempt (int): Номер попытки, начиная с 0
+
+    Returns:
+        float: Задержка в секундах.
+    """
+    for header in ("Retry-After", "X-RateLimit-Reset"):
+        value = headers.get(header, "")
+        if value.isdigit():
+            delay = int(value)
+            # Некоторые API отдают момент сброса как unix-время
+            if delay > time.time() / 2:
+                delay -= time.time()
+            if delay <= MAX_RETRY_DELAY:
+                return max(delay, 0)
+            logger.warning("Неправдоподобное значение %s: %s", header, value)
+            break
+    return min(BACKOFF_FACTOR * 2**attempt, MAX_RETRY_DELAY)
+
+
+async def send_request(session, limiter, method, url, **kwargs):
+    """Отправляет запрос с учетом ограничений API.
+
+    При ответах 429 и 5xx запрос повторяется с экспоненциальной задержкой,
+    или через время из заголовков Retry-After и X-RateLimit-Reset. При
+    ответе 429 или X-RateLimit-Remaining: 0 ограничитель останавливается
+    для всех запросов, пока квота не обновится.
+
+    Args:
+        session (aiohttp.ClientSession): Асинхронная сессия
+        limiter (RateLimiter): Ограничитель частоты запросов
+        method (str): HTTP метод
+        url (str): Адрес запроса
+        **kwargs: Параметры для aiohttp.ClientSession.request
+
+    Returns:
+        dict: Ответ сервера.
+    """
+    for attempt in range(MAX_RETRIES + 1):
+        async with limiter:
+            async with session.request(method, url, **kwargs) as response:
+                status = response.status
+                delay = retry_delay(response.headers, attempt)
+                remaining = response.headers.get("X-RateLimit-Remaining")
+                if status == 429 or remaining == "0":
+                    logger.warning(
+                        "%s %s: квота исчерпана, пауза %.1f с", method, url, delay
+                    )
+                    limiter.pause(delay)
+                if status not in RETRY_STATUSES or attempt == MAX_RETRIES:
+                    response.raise_for_status()
+                    return orjson.loads(await response.read())
+        # При 429 запрос сам дождется конца паузы в ограничителе
+        if status != 429:
+            logger.warning("%s %s: %s, повтор через %.1f с", method, url, status, delay)
+            await asyncio.sleep(delay)
+
 
 def get_product_list(last_id, client_id, seller_token):
     """Получить список товаров магазина озон.
@@ -26,6 +208,7 @@ def get_product_list(last_id, client_id, seller_token):
     headers = {
         "Client-Id": client_id,
         "Api-Key": seller_token,
+        "Content-Type": "application/json",
     }
     payload = {
         "filter": {
@@ -34,9 +217,9 @@ def get_product_list(last_id, client_id, seller_token):
         "last_id": last_id,
         "limit": 1000,
     }
-    response = requests.post(url, json=payload, headers=headers)
+    response = SESSION.post(url, data=orjson.dumps(payload), headers=headers)
     response.raise_for_status()
-    response_object = response.json()
+    response_object = orjson.loads(response.content)
     return response_object.get("result")
 
 
@@ -50,22 +233,27 @@ def get_offer_ids(client_id, seller_token):
     Returns:
         list: Возвращает список ID предложений
     """
+    # last_id - непрозрачный курсор, поэтому страницы запрашиваются по очереди
     last_id = ""
-    product_list = []
+    offer_ids = []
     while True:
         some_prod = get_product_list(last_id, client_id, seller_token)
-        product_list.extend(some_prod.get("items"))
+        items = some_prod.get("items")
+        offer_ids.extend(product.get("offer_id") for product in items)
         total = some_prod.get("total")
         last_id = some_prod.get("last_id")
-        if total == len(product_list):
+        if total <= len(offer_ids) or not items or not last_id:
             break
-    offer_ids = []
-    for product in product_list:
-        offer_ids.append(product.get("offer_id"))
     return offer_ids
 
 
-def update_price(prices: list, client_id: str, seller_token: str):
+async def update_price(
+    prices: list,
+    client_id: str,
+    seller_token: str,
+    session: aiohttp.ClientSession,
+    limiter: RateLimiter,
+):
     """Обновить цены товаров.
 
     Функция обновляет цены товара на Озон
@@ -74,6 +262,8 @@ def update_price(prices: list, client_id: str, seller_token: str):
         prices (list): Список цен
         client_id (str): Персональный ID клиента
         seller_token (str)Ж Персональный токен продавца
+        session (aiohttp.ClientSession): Асинхронная сессия
+        limiter (RateLimiter): Ограничитель частоты запросов
 
     Returns:
         json: Возвращает json с ценами.
@@ -82,14 +272,15 @@ def update_price(prices: list, client_id: str, seller_token: str):
     headers = {
         "Client-Id": client_id,
         "Api-Key": seller_token,
+        "Content-Type": "application/json",
     }
     payload = {"prices": prices}
-    response = requests.post(url, json=payload, headers=headers)
-    response.raise_for_status()
-    return response.json()
+    return await send_request(
+        session, limiter, "POST", url, data=orjson.dumps(payload), headers=headers
+    )
 
 
-def update_stocks(stocks: list, client_id, seller_token):
+async def update_stocks(stocks: list, client_id, seller_token, session, limiter):
     """Обновляет остатки.
 
     Функция делает запрос через апи озона и обновляет остатки
@@ -98,6 +289,8 @@ def update_stocks(stocks: list, client_id, seller_token):
         stocks (list): список запасов.
         client_id (str): Персональный id клиента
         seller_token (str): Персональный токен продавца.
+        session (aiohttp.ClientSession): Асинхронная сессия
+        limiter (RateLimiter): Ограничитель частоты запросов
 
     Returns:
         json: Возвращает json-строку.
@@ -107,113 +300,141 @@ def update_stocks(stocks: list, client_id, seller_token):
     headers = {
         "Client-Id": client_id,
         "Api-Key": seller_token,
+        "Content-Type": "application/json",
     }
     payload = {"stocks": stocks}
-    response = requests.post(url, json=payload, headers=headers)
-    response.raise_for_status()
-    return response.json()
+    return await send_request(
+        session, limiter, "POST", url, data=orjson.dumps(payload), headers=headers
+    )
 
 
 def download_stock():
-    """Функция скачивает файл ostatki с сайта casio."""
+    """Функция скачивает файл ostatki с сайта casio.
+
+    Returns:
+        pd.DataFrame: Таблица остатков часов.
+    """
     casio_url = "https://timeworld.ru/upload/files/ostatki.zip"
-    session = requests.Session()
-    response = session.get(casio_url)
-    response.raise_for_status()
-    with response, zipfile.ZipFile(io.BytesIO(response.content)) as archive:
-        archive.extractall(".")
-    # Создаем список остатков часов:
-    excel_file = "ostatki.xls"
-    watch_remnants = pd.read_excel(
-        io=excel_file,
-        na_values=None,
-        keep_default_na=False,
-        header=17,
-    ).to_dict(orient="records")
-    os.remove("./ostatki.xls")  # Удалить файл
+    # ZipFile нужен поиск по файлу, поэтому архив собираем в памяти
+    archive_file = io.BytesIO()
+    with SESSION.get(casio_url, stream=True) as response:
+        response.raise_for_status()
+        for chunk in response.iter_content(chunk_size=64 * 1024):
+            archive_file.write(chunk)
+    # Создаем список остатков часов, не распаковывая архив на диск:
+    with zipfile.ZipFile(archive_file) as archive:
+        with archive.open("ostatki.xls") as excel_file:
+            watch_remnants = pd.read_excel(
+                io=excel_file,
+                na_values=None,
+                keep_default_na=False,
+                header=17,
+                engine="calamine",
+                usecols=["Код", "Количество", "Цена"],
+                dtype={"Код": str, "Количество": str, "Цена": str},
+            )
     return watch_remnants
 
 
-def create_stocks(watch_remnants: list, offer_ids: list) -> list[dict]:
+def create_stocks(watch_remnants: pd.DataFrame, offer_ids: list) -> list[dict]:
     """Функция создает список запасов.
 
     Args:
-        watch_remnants (list):
+        watch_remnants (pd.DataFrame): Таблица с остатками часов
         offer_ids (list): Список ИД товаров
 
     Returns:
         stocks (list[dict]): Список остатков.
     """
-    stocks = []
-    for watch in watch_remnants:
-        if str(watch.get("Код")) in offer_ids:
-            count = str(watch.get("Количество"))
-            if count == ">10":
-                stock = 100
-            elif count == "1":
-                stock = 0
-            else:
-                stock = int(watch.get("Количество"))
-            stocks.append({"offer_id": str(watch.get("Код")), "stock": stock})
-            offer_ids.remove(str(watch.get("Код")))
-    for offer_id in offer_ids:
+    offer_ids_set = set(offer_ids)
+    codes = watch_remnants["Код"].astype(str)
+    # Каждый товар берем один раз, по первой строке с его кодом
+    loaded = codes.isin(offer_ids_set) & ~codes.duplicated()
+    counts = stock_conversion(watch_remnants.loc[loaded, "Количество"])
+    stocks = [
+        {"offer_id": code, "stock": stock}
+        for code, stock in zip(codes[loaded], counts.tolist())
+    ]
+    matched = set(codes[loaded])
+    missing = offer_ids_set - matched
+    for offer_id in missing:
         stocks.append({"offer_id": offer_id, "stock": 0})
     return stocks
 
 
-def create_prices(watch_remnants: dict, offer_ids: list) -> list[dict[str, str]]:
+def create_prices(
+    watch_remnants: pd.DataFrame, offer_ids: list
+) -> list[dict[str, str]]:
     """Функция создает список цен.
 
     Args:
-        watch_remnants (dict): словарь с остатками часов
+        watch_remnants (pd.DataFrame): Таблица с остатками часов
         offer_ids (list): список с id товарами.
 
     Returns:
         list(dict[str, str]): Список цен.
     """
-    prices = []
-    for watch in watch_remnants:
-        if str(watch.get("Код")) in offer_ids:
-            price = {
-                "auto_action_enabled": "UNKNOWN",
-                "currency_code": "RUB",
-                "offer_id": str(watch.get("Код")),
-                "old_price": "0",
-                "price": price_conversion(watch.get("Цена")),
-            }
-            prices.append(price)
-    return prices
+    codes = watch_remnants["Код"].astype(str)
+    loaded = codes.isin(set(offer_ids))
+    converted = prices_conversion(watch_remnants.loc[loaded, "Цена"])
+    return [
+        {
+            "auto_action_enabled": "UNKNOWN",
+            "currency_code": "RUB",
+            "offer_id": code,
+            "old_price": "0",
+            "price": price,
+        }
+        for code, price in zip(codes[loaded], converted.tolist())
+    ]
+
+
+def stock_conversion(quantities: pd.Series) -> pd.Series:
+    """Преобразовывает остатки в количество для маркетплейса.
+
+    Остаток ">10" считается как 100, а остаток "1" как 0.
 
+    Args:
+        quantities (pd.Series): [">10", "1", 5]
+
+    Returns:
+        pd.Series: [100, 0, 5]
+    """
+    quantities = quantities.astype(str).replace({">10": "100", "1": "0"})
+    return pd.to_numeric(quantities).astype(int)
 
-def price_conversion(price: str) -> str:
-    """Преобразовывает цену.
+
+def prices_conversion(prices: pd.Series) -> pd.Series:
+    """Преобразовывает столбец цен.
+
+    Отбрасывает копейки после первой точки и оставляет в цене только цифры.
 
     Args:
-        price (str): 5'990.00 руб
+        prices (pd.Series): ["5'990.00 руб"]
 
     Returns:
-        str: 5990
-
-    Raises:
-        AttributeError: Должна быть строка.
+        pd.Series: ["5990"]
     """
-    return re.sub("[^0-9]", "", price.split(".")[0])
+    integer_parts = prices.astype(str).str.split(".", n=1).str[0]
+    return integer_parts.str.replace(_PRICE_RE, "", regex=True)
 
 
-def divide(lst: list, n: int):
+def divide(lst: Iterable, n: int):
     """Разделяет список на части.
 
-    Разделить список lst на части по n элементов
+    Разделить список lst на части по n элементов. Вместо списка можно
+    передать любой итерируемый объект, например генератор.
 
     Args:
-        lst (list): [1, 2, 3, 4, 5]
+        lst (Iterable): [1, 2, 3, 4, 5]
         n (int): 4
 
     Returns:
         <generator object divide at>:
 
     Raises:
-        AttributeError: Должна быть список, и int.
+        TypeError: Должен быть итерируемый объект, и int.
+        ValueError: n должно быть не меньше 1.
 
     Examples:
         Этот пример показывает как использовать функцию.
@@ -226,68 +447,112 @@ def divide(lst: list, n: int):
         >>> list(a)
         >>> [[0, 1], [2, 3], [4, 5], [6, 7], [8, 9]]
     """
-    for i in range(0, len(lst), n):
-        yield lst[i: i + n]
+    if n < 1:
+        raise ValueError(f"Размер части должен быть не меньше 1, получено {n}")
+    iterator = iter(lst)
+    while chunk := list(islice(iterator, n)):
+        yield chunk
 
 
-async def upload_prices(watch_remnants, client_id, seller_token):
+async def upload_prices(
+    watch_remnants, client_id, seller_token, offer_ids=None, limiter=None
+):
     """Функция асинхронно создает список цен.
 
     Args:
-        watch_remnants (dict): словарь с остатками часов
+        watch_remnants (pd.DataFrame): Таблица с остатками часов
         client_id (str): Строка с ID клиенто
         seller_token (str): Персональный токен продавца
+        offer_ids (list): Артикулы товаров. Если не переданы, запрашиваются
+            у Озон
+        limiter (RateLimiter): Ограничитель частоты запросов. Общий для всех
+            загрузок с одними учетными данными, если не передан - создается
 
     Returns:
         list[dict[str, str]]: список содержащий словари.
 
     """
-    offer_ids = get_offer_ids(client_id, seller_token)
+    if offer_ids is None:
+        offer_ids = await asyncio.to_thread(get_offer_ids, client_id, seller_token)
     prices = create_prices(watch_remnants, offer_ids)
-    for some_price in list(divide(prices, 1000)):
-        update_price(some_price, client_id, seller_token)
+    if limiter is None:
+        limiter = RateLimiter()
+    async with create_client_session() as session:
+        tasks = [
+            update_price(some_price, client_id, seller_token, session, limiter)
+            for some_price in divide(prices, 1000)
+        ]
+        await asyncio.gather(*tasks)
     return prices
 
 
-async def upload_stocks(watch_remnants, client_id, seller_token):
+async def upload_stocks(
+    watch_remnants, client_id, seller_token, offer_ids=None, limiter=None
+):
     """Функция асинхронно создает список запасов.
 
     Args:
-        watch_remnants (dict): словарь с остатками часов
+        watch_remnants (pd.DataFrame): Таблица с остатками часов
         client_id (str): Строка с ID клиенто
         seller_token (str): Персональный токен продавца
+        offer_ids (list): Артикулы товаров. Если не переданы, запрашиваются
+            у Озон
+        limiter (RateLimiter): Ограничитель частоты запросов. Общий для всех
+            загрузок с одними учетными данными, если не передан - создается
 
     Returns:
         list: Не пустой список
         list: список содержащий словари.
 
     """
-    offer_ids = get_offer_ids(client_id, seller_token)
+    if offer_ids is None:
+        offer_ids = await asyncio.to_thread(get_offer_ids, client_id, seller_token)
     stocks = create_stocks(watch_remnants, offer_ids)
-    for some_stock in list(divide(stocks, 100)):
-        update_stocks(some_stock, client_id, seller_token)
+    if limiter is None:
+        limiter = RateLimiter()
+    async with create_client_session() as session:
+        tasks = [
+            update_stocks(some_stock, client_id, seller_token, session, limiter)
+            for some_stock in divide(stocks, 100)
+        ]
+        await asyncio.gather(*tasks)
     not_empty = list(filter(lambda stock: (stock.get("stock") != 0), stocks))
     return not_empty, stocks
 
 
+async def upload_remnants(watch_remnants, client_id, seller_token):
+    """Функция одновременно загружает остатки и цены на Озон.
+
+    Args:
+        watch_remnants (pd.DataFrame): Таблица с остатками часов
+        client_id (str): Строка с ID клиенто
+        seller_token (str): Персональный токен продавца
+
+    """
+    offer_ids = await asyncio.to_thread(get_offer_ids, client_id, seller_token)
+    # Лимиты Озон считаются на Client-Id, поэтому ограничитель общий
+    limiter = RateLimiter()
+    await asyncio.gather(
+        upload_stocks(watch_remnants, client_id, seller_token, offer_ids, limiter),
+        upload_prices(watch_remnants, client_id, seller_token, offer_ids, limiter),
+    )
+
+
 def main():
     """Ключевая функция запуска скрипта."""
     env = Env()
     seller_token = env.str("SELLER_TOKEN")
     client_id = env.str("CLIENT_ID")
     try:
-        offer_ids = get_offer_ids(client_id, seller_token)
         watch_remnants = download_stock()
-        stocks = create_stocks(watch_remnants, offer_ids)
-        for some_stock in list(divide(stocks, 100)):
-            update_stocks(some_stock, client_id, seller_token)
-        # Поменять цены
-        prices = create_prices(watch_remnants, offer_ids)
-        for some_price in list(divide(prices, 900)):
-            update_price(some_price, client_id, seller_token)
-    except requests.exceptions.ReadTimeout:
+        # Обновить остатки и поменять цены
+        asyncio.run(upload_remnants(watch_remnants, client_id, seller_token))
+    except (requests.exceptions.ReadTimeout, asyncio.TimeoutError):
         print("Превышено время ожидания...")
-    except requests.exceptions.ConnectionError as error:
+    except (
+        requests.exceptions.ConnectionError,
+        aiohttp.ClientConnectionError,
+    ) as error:
         print(error, "Ошибка соединения")
     except Exception as error:
         print(error, "ERROR_2")